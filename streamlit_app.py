@@ -1,57 +1,222 @@
 import streamlit as st
-import httpx
-import asyncio
+import orjson
+import os
+import secrets
+import sqlite3
+import threading
 import time
-import uuid
+from collections import OrderedDict, deque
 from typing import Optional
-from dotenv import load_dotenv
-from langchain_core.messages import HumanMessage, AIMessage
 
-load_dotenv()
+@st.cache_resource
+def load_env():
+    """Load .env once per process instead of on every rerun"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+load_env()
+
+ANSWER_CACHE_TTL = 24 * 60 * 60  # seconds
+ANSWER_CACHE_MAX_ENTRIES = 256
+MAX_SAVED_CHATS = 20
+PHASE_LABELS = {
+    "retrieval": "🔍 Searching SOWs...",
+    "generation": "✍️ Generating answer..."
+}
+JSON_HEADERS = {"content-type": "application/json"}
+NOT_FOUND_BODY = {"detail": "Not Found"}  # FastAPI's reply for an unknown route
+CONFIDENCE_LEVELS = ((8, "🟢", "High"), (6, "🟡", "Medium"), (0, "🔴", "Low"))
+CHAT_STORE_PATH = os.getenv(
+    "CHAT_STORE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "sow-streamlit", "chat_store.sqlite3")
+)
+CHAT_STORE_TTL = 7 * 24 * 60 * 60  # seconds; saved chats of ended sessions are purged after this
 
 # Load custom CSS
+@st.cache_data
+def read_css(path: str) -> str:
+    """Read a CSS file once per process"""
+    with open(path) as f:
+        return f.read()
+
 def load_css():
     """Load custom CSS from external file"""
-    import os
     css_file = os.path.join(os.path.dirname(__file__), "style.css")
-    with open(css_file) as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+    st.markdown(f"<style>{read_css(css_file)}</style>", unsafe_allow_html=True)
 
 load_css()
 
 # Initialize session state
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = []  # List of {role, content[, confidence]}
 if "thread_id" not in st.session_state:
     st.session_state.thread_id = None
 if "conversation_count" not in st.session_state:
-    st.session_state.conversation_count = 0
+    st.session_state.conversation_count = 0  # answered turns shown in the transcript
+if "backend_turn" not in st.session_state:
+    st.session_state.backend_turn = 0  # turns the backend has seen (cache hits excluded)
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []  # List of {id, title, messages, timestamp}
+    st.session_state.chat_history = deque(maxlen=MAX_SAVED_CHATS)  # Newest first: {id, title, label, thread_id, count, backend_turn, timestamp}
+if "chat_index" not in st.session_state:
+    st.session_state.chat_index = {}  # chat id -> entry in chat_history
 if "active_chat_id" not in st.session_state:
     st.session_state.active_chat_id = None
 
+def reset_chat():
+    """Clear the active conversation so the next question starts a new thread"""
+    st.session_state.messages = []
+    st.session_state.thread_id = None
+    st.session_state.conversation_count = 0
+    st.session_state.backend_turn = 0
+    st.session_state.active_chat_id = None
+
+@st.cache_resource
+def get_chat_store():
+    """SQLite store holding the full message list of each saved chat"""
+    os.makedirs(os.path.dirname(CHAT_STORE_PATH), mode=0o700, exist_ok=True)
+    conn = sqlite3.connect(CHAT_STORE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chats "
+        "(id TEXT PRIMARY KEY, messages BLOB NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS chats_updated_at ON chats (updated_at)")
+    conn.commit()
+    return conn, threading.Lock()
+
+def save_chat_messages(chat_id: str, messages: list):
+    """Persist a chat's messages, replacing any previous version and purging expired chats"""
+    conn, lock = get_chat_store()
+    now = time.time()
+    with lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO chats (id, messages, updated_at) VALUES (?, ?, ?)",
+            (chat_id, orjson.dumps(messages), now)
+        )
+        # Sessions are never told when they end, so their chats expire instead
+        conn.execute("DELETE FROM chats WHERE updated_at < ?", (now - CHAT_STORE_TTL,))
+        conn.commit()
+
+def load_chat_messages(chat_id: str) -> list:
+    """Load a saved chat's messages (empty if it is no longer stored)"""
+    conn, lock = get_chat_store()
+    with lock:
+        row = conn.execute("SELECT messages FROM chats WHERE id = ?", (chat_id,)).fetchone()
+    return orjson.loads(row[0]) if row else []
+
+def delete_chat_messages(chat_id: str):
+    """Remove a saved chat's messages from the store"""
+    conn, lock = get_chat_store()
+    with lock:
+        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        conn.commit()
+
+@st.cache_resource
+def get_http_transport():
+    """Connection pool to the backend, retrying failed connection attempts"""
+    import httpx  # deferred: only needed once the first question is asked
+    return httpx.HTTPTransport(
+        limits=httpx.Limits(
+            max_keepalive_connections=20,
+            max_connections=100,
+            keepalive_expiry=60.0
+        ),
+        http2=True,
+        retries=2,
+    )
+
+@st.cache_resource
+def get_http_client():
+    """Shared HTTP client so the backend connection is reused across reruns"""
+    import httpx
+    return httpx.Client(
+        transport=get_http_transport(),
+        base_url=os.getenv("FASTAPI_URL", "http://localhost:8000"),
+        timeout=httpx.Timeout(600.0, connect=5.0, pool=10.0),
+    )
+
 # Helper function for API calls
-async def query_rag(question: str, thread_id: Optional[str] = None):
+def query_rag(question: str, thread_id: Optional[str] = None):
     """Query the RAG system with optional thread_id for conversation continuity"""
-    import os
-    fastapi_url = os.getenv("FASTAPI_URL", "http://localhost:8000")
     params = {}
     if thread_id:
         params["thread_id"] = thread_id
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{fastapi_url}/api/v1/retrieval/query",
-            json={
+    response = get_http_client().post(
+        "/api/v1/retrieval/query",
+        content=orjson.dumps({
+            "question": question,
+            "max_iterations": 3
+        }),
+        headers=JSON_HEADERS,
+        params=params
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+@st.cache_resource
+def get_stream_support():
+    """Whether the backend has the streaming endpoint; set False once it is reported missing"""
+    return {"available": True}
+
+def is_missing_route(response) -> bool:
+    """True only for FastAPI's default 404 body, not a 404 raised by the route itself"""
+    if response.status_code != 404:
+        return False
+    try:
+        return orjson.loads(response.read()) == NOT_FOUND_BODY
+    except orjson.JSONDecodeError:
+        return False
+
+def stream_rag(question: str, thread_id: Optional[str] = None):
+    """Stream the RAG answer as NDJSON: {"phase"[, "token"]} progress events, then the final result"""
+    params = {}
+    if thread_id:
+        params["thread_id"] = thread_id
+    
+    stream_support = get_stream_support()
+    if stream_support["available"]:
+        with get_http_client().stream(
+            "POST",
+            "/api/v1/retrieval/query/stream",
+            content=orjson.dumps({
                 "question": question,
                 "max_iterations": 3
-            },
-            params=params,
-            timeout=600.0
-        )
-        response.raise_for_status()
-        return response.json()
+            }),
+            headers=JSON_HEADERS,
+            params=params
+        ) as response:
+            if not is_missing_route(response):
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        yield orjson.loads(line)
+                return
+        stream_support["available"] = False
+    
+    # Backend without the streaming endpoint: fall back to a single response
+    yield query_rag(question, thread_id)
+
+@st.cache_resource
+def get_answer_cache():
+    """Process-wide cache of RAG results keyed on (thread_id, backend turn, question)"""
+    return OrderedDict(), threading.Lock()
+
+def get_cached_answer(question: str, thread_id: Optional[str], turn: int):
+    """Return a cached result for this question at this point of the thread, if still fresh"""
+    cache, lock = get_answer_cache()
+    with lock:
+        entry = cache.get((thread_id, turn, question))
+    if entry and time.time() - entry[0] < ANSWER_CACHE_TTL:
+        return entry[1]
+    return None
+
+def cache_answer(question: str, thread_id: str, turn: int, result: dict):
+    """Store a result, dropping the oldest entries past ANSWER_CACHE_MAX_ENTRIES"""
+    cache, lock = get_answer_cache()
+    with lock:
+        cache[(thread_id, turn, question)] = (time.time(), result)
+        while len(cache) > ANSWER_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
 
 st.title("SOW - Assistant")
 
@@ -66,93 +231,63 @@ This assistant uses Redis-based memory to maintain conversation context across m
 💡 **Tip:** Ask follow-up questions like "Tell me more", "What about their deliverables?", or "Get me the names?"
 """)
 
-with st.sidebar:
-    st.header("Conversations")
-    
-    # New Chat Button at the top
-    if st.button("➕ New Chat", use_container_width=True, type="primary"):
-        # Save current chat if it has messages
-        if st.session_state.messages:
-            first_message = None
-            for msg in st.session_state.messages:
-                if isinstance(msg, HumanMessage):
-                    first_message = msg.content
-                    break
-            
-            chat_title = first_message[:50] + "..." if first_message and len(first_message) > 50 else (first_message or "New Chat")
-            
-            # Update existing chat or add new one
-            chat_exists = False
-            if st.session_state.active_chat_id:
-                for chat in st.session_state.chat_history:
-                    if chat["id"] == st.session_state.active_chat_id:
-                        chat["messages"] = st.session_state.messages.copy()
-                        chat["thread_id"] = st.session_state.thread_id
-                        chat["count"] = st.session_state.conversation_count
-                        chat_exists = True
-                        break
-            
-            if not chat_exists and st.session_state.messages:
-                new_chat = {
-                    "id": str(uuid.uuid4()),
-                    "title": chat_title,
-                    "messages": st.session_state.messages.copy(),
-                    "thread_id": st.session_state.thread_id,
-                    "count": st.session_state.conversation_count,
-                    "timestamp": time.time()
-                }
-                st.session_state.chat_history.insert(0, new_chat)
-        
-        # Start new chat
-        st.session_state.messages = []
-        st.session_state.thread_id = None
-        st.session_state.conversation_count = 0
-        st.session_state.active_chat_id = None
+def delete_chat(chat_id: str):
+    """Delete button callback; asks for a full rerun only if the open chat was deleted"""
+    chat = st.session_state.chat_index.pop(chat_id, None)
+    if chat is None:  # already deleted (e.g. a double click)
+        return
+    st.session_state.chat_history.remove(chat)
+    delete_chat_messages(chat_id)
+    if chat_id == st.session_state.active_chat_id:
+        reset_chat()
+        st.session_state.needs_app_rerun = True
+
+@st.fragment
+def render_history():
+    """Sidebar list of saved chats; reruns on its own when only its widgets change"""
+    # Deleting the open chat also clears the transcript, which lives outside this fragment
+    if st.session_state.pop("needs_app_rerun", False):
         st.rerun()
     
-    st.divider()
-    
-    # Display chat history
     if st.session_state.chat_history:
         st.subheader("Chat History")
-        for idx, chat in enumerate(st.session_state.chat_history):
+        for chat in st.session_state.chat_history:
             col1, col2 = st.columns([4, 1])
             
             with col1:
                 # Create a button for each chat
                 if st.button(
-                    f"💬 {chat['title']}", 
+                    chat["label"], 
                     key=f"chat_{chat['id']}",
                     use_container_width=True,
                     type="secondary" if chat["id"] == st.session_state.active_chat_id else "primary"
                 ):
                     # Load this chat
-                    st.session_state.messages = chat["messages"].copy()
+                    st.session_state.messages = load_chat_messages(chat["id"])
                     st.session_state.thread_id = chat["thread_id"]
                     st.session_state.conversation_count = chat["count"]
+                    st.session_state.backend_turn = chat["backend_turn"]
                     st.session_state.active_chat_id = chat["id"]
                     st.rerun()
             
             with col2:
                 # Delete button
-                if st.button("🗑️", key=f"del_{chat['id']}", help="Delete this chat"):
-                    st.session_state.chat_history.pop(idx)
-                    if chat["id"] == st.session_state.active_chat_id:
-                        st.session_state.messages = []
-                        st.session_state.thread_id = None
-                        st.session_state.conversation_count = 0
-                        st.session_state.active_chat_id = None
-                    st.rerun()
+                st.button(
+                    "🗑️",
+                    key=f"del_{chat['id']}",
+                    help="Delete this chat",
+                    on_click=delete_chat,
+                    args=(chat["id"],)
+                )
             
             # Show message count
             st.caption(f" {chat['count']} messages")
             st.divider()
     else:
         st.info("No chat history yet. Start a conversation!")
-    
-    st.divider()
-    
-    # Current Chat Info
+
+def render_current_chat_info():
+    """Sidebar summary of the active conversation"""
     st.header("Current Chat")
     if st.session_state.thread_id:
         st.write(f"**Thread ID:** `{st.session_state.thread_id[:12]}...`")
@@ -163,94 +298,213 @@ with st.sidebar:
     # Clear current chat button
     if st.session_state.messages:
         if st.button("🗑️ Clear Current Chat", use_container_width=True):
-            st.session_state.messages = []
-            st.session_state.thread_id = None
-            st.session_state.conversation_count = 0
-            st.session_state.active_chat_id = None
+            reset_chat()
             st.rerun()
 
+with st.sidebar:
+    st.header("Conversations")
+    
+    # New Chat Button at the top
+    if st.button("➕ New Chat", use_container_width=True, type="primary"):
+        # Save current chat if it has messages
+        if st.session_state.messages:
+            # Update existing chat or add new one
+            chat = st.session_state.chat_index.get(st.session_state.active_chat_id)
+            if chat:
+                save_chat_messages(chat["id"], st.session_state.messages)
+                chat["thread_id"] = st.session_state.thread_id
+                chat["count"] = st.session_state.conversation_count
+                chat["backend_turn"] = st.session_state.backend_turn
+            else:
+                # Title is computed once here; the history list reuses it verbatim
+                first_message = None
+                for msg in st.session_state.messages:
+                    if msg["role"] == "user":
+                        first_message = msg["content"]
+                        break
+                
+                chat_title = first_message[:50] + "..." if first_message and len(first_message) > 50 else (first_message or "New Chat")
+                
+                new_chat = {
+                    "id": secrets.token_hex(8),
+                    "title": chat_title,
+                    "label": f"💬 {chat_title}",
+                    "thread_id": st.session_state.thread_id,
+                    "count": st.session_state.conversation_count,
+                    "backend_turn": st.session_state.backend_turn,
+                    "timestamp": time.time()
+                }
+                save_chat_messages(new_chat["id"], st.session_state.messages)
+                
+                # Drop the oldest chat (and its stored messages) once the history is full
+                history = st.session_state.chat_history
+                if len(history) == history.maxlen:
+                    oldest = history.pop()
+                    del st.session_state.chat_index[oldest["id"]]
+                    delete_chat_messages(oldest["id"])
+                history.appendleft(new_chat)
+                st.session_state.chat_index[new_chat["id"]] = new_chat
+        
+        # Start new chat
+        reset_chat()
+        st.rerun()
+    
+    st.divider()
+    
+    # Display chat history
+    render_history()
+    
+    st.divider()
+    
+    # Current Chat Info
+    render_current_chat_info()
+
+
+def format_answer(answer: str, confidence: float) -> str:
+    """Answer markdown followed by its confidence indicator"""
+    for threshold, emoji, label in CONFIDENCE_LEVELS:
+        if confidence >= threshold:
+            break
+    return f"{answer}\n\n*Confidence: {emoji} {label} ({confidence:.1f}/10)*"
+
+def close_code_fences(text: str) -> str:
+    """Append a closing fence if the text ends inside a ``` or ~~~ code block"""
+    open_fence = None
+    for line in text.split("\n"):
+        stripped = line.lstrip()
+        for fence in ("```", "~~~"):
+            if stripped.startswith(fence):
+                if open_fence is None:
+                    open_fence = fence
+                elif open_fence == fence:
+                    open_fence = None
+                break
+    return f"{text}\n{open_fence}" if open_fence else text
+
+def turn_html(message: dict) -> str:
+    """One transcript turn as a role-styled div.
+
+    Only "<" is escaped: that is enough to stop tags (including a stray </div>)
+    while leaving ">" blockquotes and "&" intact. Caveat: a literal "<" inside a
+    code span or code block is shown as "&lt;", since CommonMark does not decode
+    entities there.
+    """
+    content = close_code_fences(message["content"].replace("<", "&lt;"))
+    if message["role"] == "assistant":
+        content = format_answer(content, message["confidence"])
+    return f'<div class="chat-turn {message["role"]}">\n\n{content}\n\n</div>'
 
 # Display the chat history
-for message in st.session_state.messages:
-    if isinstance(message, HumanMessage):
-        with st.chat_message("user"):
-            st.write(message.content)
-    elif isinstance(message, AIMessage):
-        with st.chat_message("assistant"):
-            st.write(message.content)
+def render_messages(messages: list):
+    """Render the transcript as one markdown block rather than a chat_message per turn"""
+    if messages:
+        # All turns share one markdown document, so each turn must be self-contained:
+        # an unclosed code fence would swallow every later turn (see close_code_fences).
+        st.markdown("\n\n".join(turn_html(m) for m in messages), unsafe_allow_html=True)
+
+render_messages(st.session_state.messages)
 
 # Handle new user input
 # Handle new user input
 if prompt := st.chat_input("Ask me anything about our SOWs..."):
+    import httpx
+    
     # Add user message to chat history
-    user_message = HumanMessage(content=prompt)
+    user_message = {"role": "user", "content": prompt}
     st.session_state.messages.append(user_message)
     
-    # Display user message
-    with st.chat_message("user"):
-        st.write(prompt)
+    # Display user message, styled like the transcript above it
+    st.markdown(turn_html(user_message), unsafe_allow_html=True)
 
-    # Query the RAG system
-    with st.chat_message("assistant"):
+    # Query the RAG system (the live answer is plain markdown, so no raw HTML)
+    with st.container(key="live_answer"):
+        # Progress (if any) goes above the answer, so reserve its slot first
+        status_slot = st.empty()
         message_placeholder = st.empty()
         
         try:
             # Track response time
             start_time = time.time()
             
-            # Show loading spinner while processing
-            with st.spinner("🔍 Searching and analyzing..."):
-                result = asyncio.run(query_rag(prompt, st.session_state.thread_id))
+            # A question repeated at the same backend turn of a thread (e.g. after reopening
+            # a saved chat) is answered from the cache. Follow-ups like "Tell me more"
+            # at a later turn depend on context, so the turn is part of the key.
+            # New threads are never cached: the backend assigns their thread_id.
+            partial = ""
+            result = None
+            if st.session_state.thread_id:
+                result = get_cached_answer(
+                    prompt, st.session_state.thread_id, st.session_state.backend_turn
+                )
+            from_cache = result is not None
+            
+            if result is None:
+                result = {}
+                with status_slot.status("🔌 Connecting...") as status:
+                    def answer_tokens():
+                        """Yield answer tokens, reporting backend phases on the status widget"""
+                        phase = None
+                        for event in stream_rag(prompt, st.session_state.thread_id):
+                            if event.get("phase") != phase and event.get("phase") in PHASE_LABELS:
+                                phase = event["phase"]
+                                status.update(label=PHASE_LABELS[phase])
+                            if "token" in event:
+                                yield event["token"]
+                            else:
+                                result.update(event)
+                    
+                    # Render tokens as they arrive
+                    partial = message_placeholder.write_stream(answer_tokens()) or ""
+                    status.update(label="✅ Answer ready", state="complete")
+            
+            # The backend owns conversation threads and must tell us which one this is.
+            # thread_id arrives with the final event, so a streamed answer is already on
+            # screen here; the error replaces it and nothing is saved or cached.
+            if "thread_id" not in result:
+                raise ValueError("Backend response did not include a thread_id")
             
             # Calculate response time
             end_time = time.time()
             response_time = end_time - start_time
             
             # Extract response
-            answer = result.get("answer", "No answer received")
+            answer = result.get("answer", partial or "No answer received")
             confidence = result.get("confidence", 0.0)
             
-            # Display answer
-            full_response = f"{answer}\n\n"
-            
-            # Add confidence indicator
-            if confidence >= 8:
-                confidence_emoji = "🟢"
-                confidence_text = "High"
-            elif confidence >= 6:
-                confidence_emoji = "🟡"
-                confidence_text = "Medium"
-            else:
-                confidence_emoji = "🔴"
-                confidence_text = "Low"
-            
-            full_response += f"*Confidence: {confidence_emoji} {confidence_text} ({confidence:.1f}/10)*"
-            
-            message_placeholder.markdown(full_response)
+            # Display answer with confidence indicator
+            message_placeholder.markdown(format_answer(answer, confidence))
             
             # Show response time
             st.caption(f"⏱️ Response time: {response_time:.2f}s")
             
-            # Show thread info for first message
-            if not st.session_state.thread_id:
-                st.info("💡 Your conversation has started! Ask follow-up questions to continue this thread.")
+            if from_cache:
+                # The backend never saw this turn, so the thread does not advance
+                st.caption("⚡ Answered from cache")
             else:
-                st.caption(f"💬 Conversation #{st.session_state.conversation_count + 1} in this thread")
-            
-            # Update session state
-            if not st.session_state.thread_id:
-                # First message - need to extract thread_id from logs or generate
-                # Since API doesn't return it yet, we'll generate one
-                st.session_state.thread_id = result.get("thread_id", str(uuid.uuid4()))
+                # Show thread info for first message
+                if not st.session_state.thread_id:
+                    st.info("💡 Your conversation has started! Ask follow-up questions to continue this thread.")
+                else:
+                    st.caption(f"💬 Conversation #{st.session_state.backend_turn + 1} in this thread")
+                
+                # Update session state
+                st.session_state.thread_id = result["thread_id"]
+                
+                cache_answer(prompt, st.session_state.thread_id, st.session_state.backend_turn, {
+                    "answer": answer,
+                    "confidence": confidence,
+                    "thread_id": st.session_state.thread_id
+                })
+                st.session_state.backend_turn += 1
             
             st.session_state.conversation_count += 1
             
             # Add to chat history
-            st.session_state.messages.append(AIMessage(content=full_response))
+            st.session_state.messages.append({"role": "assistant", "content": answer, "confidence": confidence})
             
         except httpx.HTTPError as e:
             message_placeholder.error(f"❌ API request failed: {str(e)}")
         except Exception as e:
             message_placeholder.error(f"❌ An error occurred: {str(e)}")
-            import traceback
-            st.error(f"Details: {traceback.format_exc()}")
+            if os.getenv("DEBUG"):
+                st.exception(e)